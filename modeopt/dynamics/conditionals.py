@@ -1,55 +1,297 @@
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import tensorflow as tf
+from gpflow import covariances, mean_functions
+from gpflow.config import default_float, default_jitter
+from gpflow.expectations import expectation
+from gpflow.inducing_variables import InducingPoints, InducingVariables
+from gpflow.kernels import Kernel
+from gpflow.models import SVGP
+from gpflow.probability_distributions import DiagonalGaussian
 
+# Cholesky/triangular solves on [M, M] matrices (M = num inducing points) are
+# dominated by cuSolver launch overhead on GPU, so they are placed on the CPU
+_SMALL_LINALG_DEVICE = "/CPU:0"
 
-def svgp_covariance_conditional(X1, X2, svgp):
+
+def _batched_inner_products(A: tf.Tensor, B: tf.Tensor) -> tf.Tensor:
+    """<A_n, B_d> = sum_ij A_nij B_dij for every n, d as a single GEMM
+
+    :param A: [N, M, M]
+    :param B: [D, M, M]
+    :returns: [N, D]
+    """
+    num_ind = tf.shape(A)[-1]
+    return tf.linalg.matmul(
+        tf.reshape(A, [-1, num_ind * num_ind]),
+        tf.reshape(B, [-1, num_ind * num_ind]),
+        transpose_b=True,
+    )
+
+
+class UncertainConditionalCache(NamedTuple):
+    """Terms of uncertain_conditional that do not depend on the inputs"""
+
+    Luu: tf.Tensor  # cholesky of Kuu [M, M]
+    Luu_inv: tf.Tensor  # inverse of Luu [M, M]
+    q_mu: tf.Tensor  # whitened inducing mean [M, Dout]
+    q_sqrt_r: tf.Tensor  # whitened lower triangular inducing cholesky [Dout, M, M]
+
+
+def prepare_uncertain_conditional_cache(
+    inducing_variable: InducingVariables,
+    kernel: Kernel,
+    q_mu: tf.Tensor,
+    q_sqrt: tf.Tensor,
+    white: bool = False,
+) -> UncertainConditionalCache:
+    """Precompute the Cholesky of Kuu and the whitened inducing variables
+
+    These only depend on the inducing variables and kernel, so they can be computed
+    once and reused for every time step of a rollout.
+    """
+    Kuu = covariances.Kuu(inducing_variable, kernel, jitter=default_jitter())  # [M, M]
+    q_sqrt_r = tf.linalg.band_part(q_sqrt, -1, 0)  # [Dout, M, M]
+    with tf.device(_SMALL_LINALG_DEVICE):
+        Luu = tf.linalg.cholesky(Kuu)  # [M, M]
+        Luu_inv = tf.linalg.triangular_solve(
+            Luu, tf.eye(tf.shape(Luu)[0], dtype=Luu.dtype), lower=True
+        )  # [M, M]
+        if not white:
+            q_mu = tf.linalg.triangular_solve(Luu, q_mu, lower=True)
+            # triangular_solve broadcasts Luu over the batch dim [Dout] so no tiling
+            q_sqrt_r = tf.linalg.triangular_solve(Luu[None, :, :], q_sqrt_r, lower=True)
+    return UncertainConditionalCache(
+        Luu=Luu, Luu_inv=Luu_inv, q_mu=q_mu, q_sqrt_r=q_sqrt_r
+    )
+
+
+def uncertain_conditional(
+    Xnew_mu: tf.Tensor,
+    Xnew_var: tf.Tensor,
+    inducing_variable: InducingVariables,
+    kernel: Kernel,
+    q_mu: tf.Tensor,
+    q_sqrt: tf.Tensor,
+    *,
+    mean_function: Optional[mean_functions.MeanFunction] = None,
+    full_output_cov: bool = False,
+    full_cov: bool = False,
+    white: bool = False,
+):
+    """Conditional for uncertain inputs Xnew, p(Xnew) = N(Xnew_mu, diag(Xnew_var))
+
+    Public, drop-in equivalent of gpflow.conditionals.uncertain_conditional for
+    inputs with diagonal covariances. Unlike gpflow (which builds a Gaussian from
+    full [N, Din, Din] covariances) the inputs are a DiagonalGaussian. The rollouts
+    use uncertain_conditional_prepared with a cache built once instead.
+
+    :param Xnew_mu: mean of the inputs [N, Din]
+    :param Xnew_var: variance of the inputs [N, Din]
+    :param inducing_variable: only InducingPoints is supported
+    :param q_mu: mean of the inducing points [M, Dout]
+    :param q_sqrt: cholesky of the covariance of the inducing points [Dout, M, M]
+    :returns: (fmean, fvar) with fmean [N, Dout] and fvar [N, Dout, Dout] if
+              full_output_cov else [N, Dout]
+    """
+    cache = prepare_uncertain_conditional_cache(
+        inducing_variable, kernel, q_mu=q_mu, q_sqrt=q_sqrt, white=white
+    )
+    return uncertain_conditional_prepared(
+        Xnew_mu,
+        Xnew_var,
+        inducing_variable,
+        kernel,
+        cache,
+        mean_function=mean_function,
+        full_output_cov=full_output_cov,
+        full_cov=full_cov,
+    )
+
+
+def uncertain_conditional_prepared(
+    Xnew_mu: tf.Tensor,
+    Xnew_var: tf.Tensor,
+    inducing_variable: InducingVariables,
+    kernel: Kernel,
+    cache: UncertainConditionalCache,
+    *,
+    mean_function: Optional[mean_functions.MeanFunction] = None,
+    full_output_cov: bool = False,
+    full_cov: bool = False,
+):
+    """uncertain_conditional using a precomputed UncertainConditionalCache"""
+    if not isinstance(inducing_variable, InducingPoints):
+        raise NotImplementedError
+    if full_cov:
+        raise NotImplementedError(
+            "uncertain_conditional() currently does not support full_cov=True"
+        )
+
+    pXnew = DiagonalGaussian(Xnew_mu, Xnew_var)
+    Luu, Luu_inv, q_mu, q_sqrt_r = cache
+
+    num_data = tf.shape(Xnew_mu)[0]  # N
+    num_ind, num_func = tf.unstack(tf.shape(q_mu), num=2, axis=0)  # M, Dout
+
+    eKuf = tf.transpose(expectation(pXnew, (kernel, inducing_variable)))  # [M, N]
+    with tf.device(_SMALL_LINALG_DEVICE):
+        Li_eKuf = tf.linalg.triangular_solve(Luu, eKuf, lower=True)  # [M, N]
+    eKff = expectation(pXnew, kernel)  # [N]
+    eKuffu = expectation(
+        pXnew, (kernel, inducing_variable), (kernel, inducing_variable)
+    )  # [N, M, M]
+    fmean, fvar = _uncertain_conditional_core(
+        Li_eKuf, eKff, eKuffu, Luu_inv, q_mu, q_sqrt_r, full_output_cov=full_output_cov
+    )
+
+    if mean_function is None or isinstance(mean_function, mean_functions.Zero):
+        e_related_to_mean = tf.zeros(
+            (num_data, num_func, num_func), dtype=default_float()
+        )
+    else:
+        # Update mean: \mu(x) + m(x)
+        fmean = fmean + expectation(pXnew, mean_function)
+
+        # Calculate: m(x) m(x)^T + m(x) \mu(x)^T + \mu(x) m(x)^T
+        e_mean_mean = expectation(pXnew, mean_function, mean_function)  # [N, D, D]
+        Lit_q_mu = tf.linalg.matmul(Luu_inv, q_mu, transpose_a=True)  # [M, Dout]
+        e_mean_Kuf = expectation(pXnew, mean_function, (kernel, inducing_variable))
+        e_mean_Kuf = tf.reshape(e_mean_Kuf, [num_data, num_func, num_ind])
+        e_fmean_mean = tf.linalg.matmul(e_mean_Kuf, Lit_q_mu)  # [N, Dout, Dout]
+        e_related_to_mean = e_fmean_mean + tf.linalg.adjoint(e_fmean_mean) + e_mean_mean
+
+    if full_output_cov:
+        fvar = fvar - fmean[:, :, None] * fmean[:, None, :] + e_related_to_mean
+    else:
+        fvar = fvar - fmean**2 + tf.linalg.diag_part(e_related_to_mean)
+    return fmean, fvar
+
+
+@tf.function(jit_compile=True)
+def _uncertain_conditional_core(
+    Li_eKuf: tf.Tensor,
+    eKff: tf.Tensor,
+    eKuffu: tf.Tensor,
+    Luu_inv: tf.Tensor,
+    q_mu: tf.Tensor,
+    q_sqrt_r: tf.Tensor,
+    full_output_cov: bool = False,
+):
+    """Pure tensor part of uncertain_conditional_prepared, compiled with XLA
+
+    The kernel expectations need the kernel/inducing variable objects so they are
+    computed by the caller, this fuses the solves/contractions that follow them.
+
+    :returns: (fmean, E[f f^T]) where the second moment excludes the mean function
+    """
+    fmean = tf.linalg.matmul(Li_eKuf, q_mu, transpose_a=True)  # [N, Dout]
+    # Luu^{-1} eKuffu Luu^{-T} as two batched matmuls (Luu_inv broadcasts over [N])
+    # instead of two triangular solves per step
+    Li_eKuffu_Lit = tf.linalg.matmul(
+        tf.linalg.matmul(Luu_inv, eKuffu), Luu_inv, transpose_b=True
+    )  # [N, M, M]
+    # cov is symmetric so tr(A cov_d) = <A, cov_d> (a single GEMM over [N, M*M])
+    cov = tf.linalg.matmul(q_sqrt_r, q_sqrt_r, transpose_b=True)  # [Dout, M, M]
+    cov_minus_eye = cov - tf.eye(tf.shape(q_mu)[0], dtype=q_mu.dtype)[None, :, :]
+
+    if full_output_cov:
+        # eKff - tr(A) + tr(A cov_d) = eKff + <A, cov_d - I>, built as [N, Dout] and
+        # written to the diagonal once (no tile or second diag)
+        diag_moment = eKff[:, None] + _batched_inner_products(
+            Li_eKuffu_Lit, cov_minus_eye
+        )  # [N, Dout]
+        fmoment = tf.linalg.diag(diag_moment) + tf.linalg.matmul(
+            q_mu, tf.linalg.matmul(Li_eKuffu_Lit, q_mu), transpose_a=True
+        )
+    else:
+        # eKff - tr(A) + tr(A cov_d) + q_d^T A q_d = eKff + <A, cov_d - I + q_d q_d^T>
+        # so the variance is assembled with a single contraction over [N, M, M]
+        q_mu_t = tf.transpose(q_mu)  # [Dout, M]
+        B = cov_minus_eye + q_mu_t[:, :, None] * q_mu_t[:, None, :]  # [Dout, M, M]
+        fmoment = eKff[:, None] + _batched_inner_products(Li_eKuffu_Lit, B)
+    return fmean, fmoment
+
+
+class GPContext(NamedTuple):
+    """Terms of covariance_conditional that only depend on the inducing variables"""
+
+    Kzz: tf.Tensor  # [M, M]
+    Lz: tf.Tensor  # cholesky of Kzz [M, M]
+    q_mu: tf.Tensor  # [M, R]
+    q_sqrt: Optional[tf.Tensor]  # [M, R] or [R, M, M]
+
+
+def prepare_gp_context(
+    kernel: Kernel, inducing_variable: InducingPoints, f, q_sqrt=None
+) -> GPContext:
+    """Evaluate K(Z, Z) and its Cholesky once so they can be reused across calls"""
+    Kzz = kernel(inducing_variable.Z, inducing_variable.Z)
+    with tf.device(_SMALL_LINALG_DEVICE):
+        Lz = tf.linalg.cholesky(Kzz)
+    return GPContext(Kzz=Kzz, Lz=Lz, q_mu=f, q_sqrt=q_sqrt)
+
+
+def prepare_svgp_context(svgp: SVGP) -> GPContext:
+    return prepare_gp_context(
+        kernel=svgp.kernel,
+        inducing_variable=svgp.inducing_variable,
+        f=svgp.q_mu,
+        q_sqrt=svgp.q_sqrt,
+    )
+
+
+def svgp_covariance_conditional(X1, X2, svgp, context: Optional[GPContext] = None):
+    if context is None:
+        context = prepare_svgp_context(svgp)
     return covariance_conditional(
         X1,
         X2,
         kernel=svgp.kernel,
         inducing_variable=svgp.inducing_variable,
-        f=svgp.q_mu,
-        q_sqrt=svgp.q_sqrt,
         white=svgp.whiten,
+        context=context,
     )
 
 
 def covariance_conditional(
-    X1, X2, kernel, inducing_variable, f, q_sqrt=None, white=False
+    X1,
+    X2,
+    kernel,
+    inducing_variable,
+    f=None,
+    q_sqrt=None,
+    white=False,
+    context: Optional[GPContext] = None,
 ):
-    K12 = kernel(X1, X2)
-    # print("K12")
-    # print(K12.shape)
-    Kmm = kernel(inducing_variable.Z, inducing_variable.Z)
-    # print("Kmm")
-    # print(Kmm.shape)
-    Lm = tf.linalg.cholesky(Kmm)
-    # print("Lm")
-    # print(Lm.shape)
+    """Posterior covariance between X1 and X2
 
+    The inducing variables (f, q_sqrt) are given either directly or by a context
+    built with prepare_gp_context, not both.
+    """
+    if context is None:
+        if f is None:
+            raise ValueError("covariance_conditional() requires f or a context")
+        context = prepare_gp_context(kernel, inducing_variable, f, q_sqrt=q_sqrt)
+    elif f is not None or q_sqrt is not None:
+        raise ValueError(
+            "covariance_conditional() takes f/q_sqrt from the context, don't pass both"
+        )
+    K12 = kernel(X1, X2)
     Km1 = kernel(inducing_variable.Z, X1)
     Km2 = kernel(inducing_variable.Z, X2)
-    # print("Km1.shape")
-    # print(Km1.shape)
-    # print(Km2.shape)
     return base_covariance_conditional(
         Km1=Km1,
         Km2=Km2,
-        Lm=Lm,
+        Lm=context.Lz,
         K12=K12,
-        f=f,
-        q_sqrt=q_sqrt,
+        f=context.q_mu,
+        q_sqrt=context.q_sqrt,
         white=white,
-        # X1,
-        # X2,
-        # kernel=svgp.kernel,
-        # inducing_variable=svgp.inducing_variable,
-        # q_mu=svgp.q_mu,
-        # q_sqrt=svgp.q_sqrt,
     )
 
 
+@tf.function(jit_compile=True)
 def base_covariance_conditional(
     Km1: tf.Tensor,
     Km2: tf.Tensor,
@@ -69,29 +311,13 @@ def base_covariance_conditional(
 
     # get the leading dims in Kmn to the front of the tensor
     # if Kmn has rank two, i.e. [M, N], this is the identity op.
-    K1 = tf.rank(Km1)
-    K2 = tf.rank(Km2)
-    perm_1 = tf.concat(
-        [
-            tf.reshape(tf.range(1, K1 - 1), [K1 - 2]),  # leading dims (...)
-            tf.reshape(0, [1]),  # [M]
-            tf.reshape(K1 - 1, [1]),
-        ],
-        0,
-    )  # [N]
-    perm_2 = tf.concat(
-        [
-            tf.reshape(tf.range(1, K2 - 1), [K2 - 2]),  # leading dims (...)
-            tf.reshape(0, [1]),  # [M]
-            tf.reshape(K2 - 1, [1]),
-        ],
-        0,
-    )  # [N]
-    Km1 = tf.transpose(Km1, perm_1)  # [..., M, N1]
-    Km2 = tf.transpose(Km2, perm_2)  # [..., M, N2]
-    # print("Km1")
-    # print(Km1.shape)
-    # print(Km2.shape)
+    # (ranks are static so the perms are python lists, not graph ops)
+    K1 = Km1.shape.ndims
+    K2 = Km2.shape.ndims
+    if K1 > 2:
+        Km1 = tf.transpose(Km1, [*range(1, K1 - 1), 0, K1 - 1])  # [..., M, N1]
+    if K2 > 2:
+        Km2 = tf.transpose(Km2, [*range(1, K2 - 1), 0, K2 - 1])  # [..., M, N2]
 
     shape_constraints = [
         (Km1, [..., "M", "N1"]),
@@ -116,14 +342,8 @@ def base_covariance_conditional(
 
     # Compute the projection matrix A
     Lm = tf.broadcast_to(Lm, tf.concat([leading_dims, tf.shape(Lm)], 0))  # [..., M, M]
-    # print("Lm")
-    # print(Lm.shape)
     A1 = tf.linalg.triangular_solve(Lm, Km1, lower=True)  # [..., M, N1]
-    # print("A1")
-    # print(A1.shape)
     A2 = tf.linalg.triangular_solve(Lm, Km2, lower=True)  # [..., M, N2]
-    # print("A2")
-    # print(A2.shape)
 
     # compute the covariance due to the conditioning
     fcov = K12 - tf.linalg.matmul(A1, A2, transpose_a=True)  # [..., N1, N2]
@@ -142,6 +362,8 @@ def base_covariance_conditional(
         if q_sqrt_dims == 2:
             LTA1 = A1 * tf.expand_dims(tf.transpose(q_sqrt), 2)  # [R, M, N1]
             LTA2 = A2 * tf.expand_dims(tf.transpose(q_sqrt), 2)  # [R, M, N2]
+            # fcov = fcov + tf.linalg.matmul(LTA, LTA, transpose_a=True)  # [R, N, N]
+            fcov = fcov + tf.linalg.matmul(LTA1, LTA2, transpose_a=True)  # [R, N1, N2]
         elif q_sqrt_dims == 3:
             L = tf.linalg.band_part(q_sqrt, -1, 0)  # force lower triangle # [R, M, M]
             L_shape = tf.shape(L)
@@ -151,16 +373,28 @@ def base_covariance_conditional(
             shape2 = tf.concat([leading_dims, [num_func, M, N2]], axis=0)
             A1_tiled = tf.broadcast_to(tf.expand_dims(A1, -3), shape1)
             A2_tiled = tf.broadcast_to(tf.expand_dims(A2, -3), shape2)
-            LTA1 = tf.linalg.matmul(L, A1_tiled, transpose_a=True)  # [R, M, N1]
-            LTA2 = tf.linalg.matmul(L, A2_tiled, transpose_a=True)  # [R, M, N2]
+
+            # A1^T L L^T A2 costs 2M^2 x (N of the side the M x M products are
+            # applied to) + M N1 N2, so associate towards the smaller of N1/N2
+            N1_static, N2_static = A1.shape[-1], A2.shape[-1]
+            if None not in (N1_static, N2_static) and N1_static < N2_static:
+                A1TL = tf.linalg.matmul(A1_tiled, L, transpose_a=True)  # [R, N1, M]
+                A1TLLT = tf.linalg.matmul(A1TL, L, transpose_b=True)  # [R, N1, M]
+                fcov = fcov + tf.linalg.matmul(A1TLLT, A2_tiled)  # [R, N1, N2]
+            elif None not in (N1_static, N2_static) and N2_static < N1_static:
+                LTA2 = tf.linalg.matmul(L, A2_tiled, transpose_a=True)  # [R, M, N2]
+                LLTA2 = tf.linalg.matmul(L, LTA2)  # [R, M, N2]
+                fcov = fcov + tf.linalg.matmul(
+                    A1_tiled, LLTA2, transpose_a=True
+                )  # [R, N1, N2]
+            else:
+                LTA1 = tf.linalg.matmul(L, A1_tiled, transpose_a=True)  # [R, M, N1]
+                LTA2 = tf.linalg.matmul(L, A2_tiled, transpose_a=True)  # [R, M, N2]
+                fcov = fcov + tf.linalg.matmul(
+                    LTA1, LTA2, transpose_a=True
+                )  # [R, N1, N2]
         else:  # pragma: no cover
             raise ValueError("Bad dimension for q_sqrt: %s" % str(q_sqrt.shape.ndims))
-        # print("LTA1")
-        # print(LTA1.shape)
-        # print(LTA2.shape)
-
-        # fcov = fcov + tf.linalg.matmul(LTA, LTA, transpose_a=True)  # [R, N, N]
-        fcov = fcov + tf.linalg.matmul(LTA1, LTA2, transpose_a=True)  # [R, N1, N2]
 
     # if not full_cov:
     #     fcov = tf.linalg.adjoint(fcov)  # [N, R]
@@ -181,34 +415,19 @@ def base_covariance_conditional(
 
 # def base_svgp_conditional(X1, X2, kernel, inducing_variable, q_mu, q_sqrt):
 #     K12 = kernel(X1, X2)
-#     # print("K12")
-#     # print(K12.shape)
 #     Kzz = kernel(inducing_variable.Z, inducing_variable.Z)
 #     # jitter=1e-6
 #     jitter = 1e-4
 #     Kzz += jitter * tf.eye(inducing_variable.num_inducing, dtype=Kzz.dtype)
-#     # print("Kzz")
-#     # print(Kzz.shape)
 #     Lz = tf.linalg.cholesky(Kzz)
-#     # print("Lz")
-#     # print(Lz.shape)
 
 #     K1z = kernel(X1, inducing_variable.Z)
 #     # Kz2 = kernel(X2, inducing_variable.Z)
 #     Kz2 = kernel(inducing_variable.Z, X2)
-#     # print("K1z.shape")
-#     # print(K1z.shape)
-#     # print(Kz2.shape)
 
 #     S = q_sqrt @ tf.transpose(q_sqrt, [0, 2, 1])
 #     A = Kzz - S[0, :, :]
-#     # print("A.shape")
-#     # print(A.shape)
 #     # B = Kz1 @ A @ tf.transpose(Kz2)
 #     B = K1z @ A @ Kz2
-#     # print("B.shape")
-#     # print(B.shape)
 #     K = K12 - B
-#     # print("K.shape")
-#     # print(K.shape)
 #     return K
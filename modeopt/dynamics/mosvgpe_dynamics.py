@@ -1,19 +1,17 @@
 #!/usr/bin/env python3
-from typing import Optional
+from typing import List, Optional
 
-import gpflow as gpf
 import tensor_annotations.tensorflow as ttf
 import tensorflow as tf
 import tensorflow_probability as tfp
 from gpflow import default_float
-from gpflow.conditionals import uncertain_conditional
 from gpflow.models import SVGP
 from gpflow.quadrature import NDiagGHQuadrature
 from modeopt.custom_types import (
     ControlDim,
     ControlTrajectoryMean,
     ControlTrajectoryVariance,
-    One,
+    InputDim,
     StateDim,
     StateTrajectoryMean,
     StateTrajectoryVariance,
@@ -23,6 +21,11 @@ from mogpe.custom_types import DatasetBatch
 from mogpe.keras.mixture_of_experts import MixtureOfSVGPExperts
 from tensor_annotations.axes import Batch
 
+from .conditionals import (
+    UncertainConditionalCache,
+    prepare_uncertain_conditional_cache,
+    uncertain_conditional_prepared,
+)
 from .svgp import SVGPDynamicsWrapper
 
 tfd = tfp.distributions
@@ -42,6 +45,12 @@ class ModeOptDynamics(tf.keras.Model):
         super().__init__(name=name)
         self.mosvgpe = mosvgpe
         self.state_dim = state_dim
+        self._rollout_step = None
+        self._whitened_cache = None
+        # counts the train_step updates (train_step runs in keras' tf.function so it
+        # can't reset the cache itself), the cache is rebuilt when it changes
+        self._num_updates = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self._cache_num_updates = None
         self.desired_mode = desired_mode
 
     def call(
@@ -73,7 +82,23 @@ class ModeOptDynamics(tf.keras.Model):
         state_var: StateTrajectoryVariance = None,
         control_var: ControlTrajectoryVariance = None,
         predict_state_difference: Optional[bool] = False,
+        cache: Optional[List[UncertainConditionalCache]] = None,
     ):
+        if cache is not None and state_var is not None and not predict_state_difference:
+            # Rollout step, use the tf.function that is only traced once
+            if control_var is None:
+                # shaped like the controls, combine_state_controls_to_input would use
+                # the state variance's shape (wrong when control_dim != state_dim)
+                control_var = tf.zeros(tf.shape(control_mean), dtype=default_float())
+            next_state_mean, next_state_var = self._compiled_rollout_step(cache)(
+                state_mean, control_mean, state_var, control_var, cache
+            )
+            # the signature's batch dim is None, restore the static shape so the
+            # outputs can be carried by a tf.while_loop that entered with [B, D]
+            return (
+                tf.ensure_shape(next_state_mean, state_mean.shape),
+                tf.ensure_shape(next_state_var, state_var.shape),
+            )
         return self.desired_mode_dynamics_gp(
             state_mean=state_mean,
             control_mean=control_mean,
@@ -81,8 +106,71 @@ class ModeOptDynamics(tf.keras.Model):
             control_var=control_var,
             predict_state_difference=predict_state_difference,
             add_noise=False,
+            cache=cache,
         )
 
+    def _compiled_rollout_step(self, cache: List[UncertainConditionalCache]):
+        """tf.function (with input_signature) for a single step of a rollout
+
+        The signature has unknown batch/control dims so it is traced once and reused
+        for every step of every rollout (until the desired mode changes).
+        """
+        if self._rollout_step is None:
+            state_spec = tf.TensorSpec([None, self.state_dim], dtype=default_float())
+            control_spec = tf.TensorSpec([None, None], dtype=default_float())
+            cache_spec = tf.nest.map_structure(
+                lambda x: tf.TensorSpec([None] * len(x.shape), dtype=x.dtype), cache
+            )
+
+            def rollout_step(state_mean, control_mean, state_var, control_var, cache):
+                return self.desired_mode_dynamics_gp(
+                    state_mean=state_mean,
+                    control_mean=control_mean,
+                    state_var=state_var,
+                    control_var=control_var,
+                    predict_state_difference=False,
+                    add_noise=False,
+                    cache=cache,
+                )
+
+            self._rollout_step = tf.function(
+                rollout_step,
+                input_signature=[
+                    state_spec,
+                    control_spec,
+                    state_spec,
+                    control_spec,
+                    cache_spec,
+                ],
+            )
+        return self._rollout_step
+
+    def prepare_cache(self) -> List[UncertainConditionalCache]:
+        """Precompute the desired mode dynamics GP terms that are fixed in rollouts
+
+        The cache (Cholesky of Kuu and whitened q_mu/q_sqrt) is reused across eager
+        rollouts until train_step updates the GPs or invalidate_cache is called.
+        Inside a tf.function it is rebuilt (eager tensors would be captured).
+        """
+        if not tf.executing_eagerly():
+            return self.desired_mode_dynamics_gp.prepare_cache()
+        num_updates = int(self._num_updates)
+        if self._whitened_cache is None or num_updates != self._cache_num_updates:
+            # not a keras tracked (checkpointed) attribute
+            self._whitened_cache = self._no_dependency(
+                self.desired_mode_dynamics_gp.prepare_cache()
+            )
+            self._cache_num_updates = num_updates
+        return self._whitened_cache
+
+    def invalidate_cache(self):
+        """Rebuild the rollout cache on the next prepare_cache
+
+        Call it after changing the GP's variables outside of train_step (e.g. with
+        gpflow's Scipy optimiser or assign).
+        """
+        self._whitened_cache = None
+
     def train_step(self, data: DatasetBatch):
         with tf.GradientTape() as tape:
             loss = -self.mosvgpe.maximum_log_likelihood_objective(data)
@@ -90,6 +178,7 @@ class ModeOptDynamics(tf.keras.Model):
         trainable_vars = self.mosvgpe.trainable_variables
         gradients = tape.gradient(loss, trainable_vars)
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
+        self._num_updates.assign_add(1)
         self.mosvgpe.loss_tracker.update_state(loss)
         return {
             "loss": self.mosvgpe.loss_tracker.result(),
@@ -108,12 +197,21 @@ class ModeOptDynamics(tf.keras.Model):
         state_var: ttf.Tensor2[Batch, StateDim] = None,
         control_var: ttf.Tensor2[Batch, ControlDim] = None,
     ):
-        h_mean, h_var = self.uncertain_predict_gating(
+        input_mean, input_var = combine_state_controls_to_input(
             state_mean=state_mean,
             control_mean=control_mean,
             state_var=state_var,
             control_var=control_var,
         )
+        return self.predict_mode_probability_given_input(input_mean, input_var)
+
+    def predict_mode_probability_given_input(
+        self,
+        input_mean: ttf.Tensor2[Batch, InputDim],
+        input_var: ttf.Tensor2[Batch, InputDim] = None,
+    ):
+        """predict_mode_probability for already concatenated state-control inputs"""
+        h_mean, h_var = self.uncertain_predict_gating_given_input(input_mean, input_var)
 
         probs = self.mosvgpe.gating_network.predict_mixing_probs_given_h(h_mean, h_var)
         if probs.shape[-1] == 1:
@@ -128,29 +226,46 @@ class ModeOptDynamics(tf.keras.Model):
         state_var: ttf.Tensor2[Batch, StateDim] = None,
         control_var: ttf.Tensor2[Batch, ControlDim] = None,
     ):
-        # TODO make this handle softmax likelihood (k>2). Just need to map over gps
         input_mean, input_var = combine_state_controls_to_input(
             state_mean=state_mean,
             control_mean=control_mean,
             state_var=state_var,
             control_var=control_var,
         )
+        return self.uncertain_predict_gating_given_input(input_mean, input_var)
+
+    def uncertain_predict_gating_given_input(
+        self,
+        input_mean: ttf.Tensor2[Batch, InputDim],
+        input_var: ttf.Tensor2[Batch, InputDim] = None,
+    ):
+        """uncertain_predict_gating for already concatenated state-control inputs
+
+        All the time steps are predicted in one call, so the gating Kuu is factorised
+        once per call (not per time step).
+        """
+        # TODO make this handle softmax likelihood (k>2). Just need to map over gps
         if input_var is None:
             h_mean, h_var = self.desired_mode_gating_gp.predict_f(
                 input_mean, full_cov=False
             )
         else:
-            h_mean, h_var = uncertain_conditional(
+            gating_cache = prepare_uncertain_conditional_cache(
+                self._gating_inducing_variable,
+                self._gating_kernel,
+                q_mu=self._gating_q_mu,
+                q_sqrt=self._gating_q_sqrt,
+                white=self._gating_whiten,
+            )
+            h_mean, h_var = uncertain_conditional_prepared(
                 input_mean,
                 input_var,
-                self.desired_mode_gating_gp.inducing_variable,
-                kernel=self.desired_mode_gating_gp.kernel,
-                q_mu=self.desired_mode_gating_gp.q_mu,
-                q_sqrt=self.desired_mode_gating_gp.q_sqrt,
-                mean_function=self.desired_mode_gating_gp.mean_function,
+                self._gating_inducing_variable,
+                kernel=self._gating_kernel,
+                cache=gating_cache,
+                mean_function=self._gating_mean_function,
                 full_output_cov=False,
                 full_cov=False,
-                white=self.desired_mode_gating_gp.whiten,
             )
         if self.mosvgpe.gating_network.num_gating_gps == 1:
             h_mean = tf.concat([h_mean, -h_mean], -1)
@@ -174,17 +289,21 @@ class ModeOptDynamics(tf.keras.Model):
         input_mean, input_var = combine_state_controls_to_input(
             state_mean, control_mean, state_var, control_var
         )
+        return self.mode_variational_expectation_given_input(input_mean, input_var)
+
+    def mode_variational_expectation_given_input(
+        self,
+        input_mean: ttf.Tensor2[Batch, InputDim],
+        input_var: ttf.Tensor2[Batch, InputDim] = None,
+    ):
+        """mode_variational_expectation for already concatenated state-control inputs"""
 
         def f(Xnew):
-            print("Xnew.shape")
-            print(Xnew.shape)
             # TODO this only works for Bernoulli likelihood
             # gating_means, gating_vars = self.gating_gp.predict_fs(Xnew, full_cov=False)
             gating_means, gating_vars = self.mosvgpe.gating_network.gp.predict_f(
                 Xnew, full_cov=False
             )
-            print("gating_means.shape")
-            print(gating_means.shape)
             # TODO how to set Y shape if more than two modes?
             Y = tf.ones(gating_means.shape, dtype=default_float()) * (
                 self.desired_mode + 1
@@ -207,12 +326,6 @@ class ModeOptDynamics(tf.keras.Model):
         )
         var_exp = gauss_quadrature(f, input_mean, input_var)
         mode_var_exp = tf.reduce_sum(var_exp)
-
-        print("input_mean.shape")
-        print(input_mean.shape)
-        print(input_var.shape)
-        print("var_exp: {}".format(var_exp))
-        print("mode_var_exp: {}".format(mode_var_exp))
         return mode_var_exp
 
     @property
@@ -222,7 +335,8 @@ class ModeOptDynamics(tf.keras.Model):
     @desired_mode_dynamics_gp.setter
     def desired_mode_dynamics_gp(self, dynamics_gp: SVGP) -> SVGPDynamicsWrapper:
         self._desired_mode_dynamics_gp = SVGPDynamicsWrapper(dynamics_gp)
-        gpf.utilities.print_summary(self._desired_mode_dynamics_gp.svgp_posterior)
+        self._rollout_step = None  # retrace as it captured the old posterior
+        self.invalidate_cache()
 
     @property
     def desired_mode(self):
@@ -231,7 +345,6 @@ class ModeOptDynamics(tf.keras.Model):
     @desired_mode.setter
     def desired_mode(self, desired_mode: int):
         """Set the desired dynamics mode GP (and build GP posterior)"""
-        print("setting desired mode to {}".format(desired_mode))
         assert desired_mode < self.mosvgpe.num_experts
         self._desired_mode = desired_mode
         self.desired_mode_dynamics_gp = self.mosvgpe.experts_list[desired_mode].gp
@@ -246,6 +359,13 @@ class ModeOptDynamics(tf.keras.Model):
         # TODO set this differently when K>2
         if self.mosvgpe.gating_network.num_gating_gps == 1:
             self._desired_mode_gating_gp = gp
+            # flat references so uncertain_predict_gating doesn't traverse the GP
+            self._gating_kernel = gp.kernel
+            self._gating_inducing_variable = gp.inducing_variable
+            self._gating_q_mu = gp.q_mu
+            self._gating_q_sqrt = gp.q_sqrt
+            self._gating_mean_function = gp.mean_function
+            self._gating_whiten = gp.whiten
         else:
             # TODO build a single output gp from a multi output gp
             raise NotImplementedError("How to convert multi output gp to single dim")
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 from functools import partial
+from typing import List, Optional
 
 import tensorflow as tf
 import tensorflow_probability as tfp
 from gpflow import posteriors
-from gpflow.conditionals import uncertain_conditional
 from gpflow.models import SVGP
 from modeopt.custom_types import (
     ControlMean,
@@ -15,6 +15,12 @@ from modeopt.custom_types import (
 )
 from modeopt.utils import combine_state_controls_to_input
 
+from .conditionals import (
+    UncertainConditionalCache,
+    prepare_uncertain_conditional_cache,
+    uncertain_conditional_prepared,
+)
+
 tfd = tfp.distributions
 
 
@@ -26,7 +32,7 @@ class SVGPDynamicsWrapper:
         # TODO make posterior work with hydra config
         # self.svgp_posterior = svgp
 
-        def uncertain_predict_f(input_mean, input_var):
+        def uncertain_predict_f(input_mean, input_var, cache=None):
             # TODO use multidispatch to handle multi-output uncertain conditionals
             f_mean, f_var = multioutput_uncertain_conditional(
                 input_mean,
@@ -41,6 +47,7 @@ class SVGPDynamicsWrapper:
                 full_output_cov=False,
                 full_cov=False,
                 whiten=svgp.whiten,
+                cache=cache,
             )
             # TODO propogate state-control uncertianty through mean function?
             f_mean = f_mean + svgp.mean_function(input_mean)
@@ -48,6 +55,14 @@ class SVGPDynamicsWrapper:
 
         self.predict_f = partial(svgp.predict_f, full_cov=False, full_output_cov=False)
         self.uncertain_predict_f = uncertain_predict_f
+        self.prepare_cache = partial(
+            multioutput_prepare_uncertain_conditional_cache,
+            inducing_variables=svgp.inducing_variable.inducing_variable,
+            kernel=svgp.kernel,
+            q_mu=svgp.q_mu,
+            q_sqrt=svgp.q_sqrt,
+            whiten=svgp.whiten,
+        )
 
     def __call__(
         self,
@@ -57,6 +72,7 @@ class SVGPDynamicsWrapper:
         control_var: ControlVariance = None,
         predict_state_difference: bool = False,
         add_noise: bool = False,
+        cache: Optional[List[UncertainConditionalCache]] = None,
     ) -> StateMeanAndVariance:
 
         input_mean, input_var = combine_state_controls_to_input(
@@ -69,7 +85,7 @@ class SVGPDynamicsWrapper:
             delta_state_mean, delta_state_var = self.predict_f(input_mean)
         else:
             delta_state_mean, delta_state_var = self.uncertain_predict_f(
-                input_mean, input_var
+                input_mean, input_var, cache=cache
             )
         # delta_state_mean, delta_state_var = self.predict_f(input_mean)
         if add_noise:
@@ -88,6 +104,28 @@ class SVGPDynamicsWrapper:
             return next_state_mean, next_state_var
 
 
+def multioutput_prepare_uncertain_conditional_cache(
+    inducing_variables, kernel, q_mu, q_sqrt=None, whiten=False
+) -> List[UncertainConditionalCache]:
+    """Build an UncertainConditionalCache for each output dimension"""
+    caches = []
+    for i, (kernel) in enumerate(kernel.kernels):
+        if len(q_sqrt.shape) == 2:
+            q_sqrt_i = q_sqrt[:, i : i + 1]
+        elif len(q_sqrt.shape) == 3:
+            q_sqrt_i = q_sqrt[i : i + 1, :, :]
+        caches.append(
+            prepare_uncertain_conditional_cache(
+                inducing_variables,
+                kernel,
+                q_mu=q_mu[:, i : i + 1],
+                q_sqrt=q_sqrt_i,
+                white=whiten,
+            )
+        )
+    return caches
+
+
 def multioutput_uncertain_conditional(
     input_mean,
     input_var,
@@ -99,26 +137,25 @@ def multioutput_uncertain_conditional(
     full_output_cov=False,
     full_cov=False,
     whiten=False,
+    cache: Optional[List[UncertainConditionalCache]] = None,
 ):
+    if cache is None:
+        cache = multioutput_prepare_uncertain_conditional_cache(
+            inducing_variables, kernel, q_mu=q_mu, q_sqrt=q_sqrt, whiten=whiten
+        )
     # TODO map instead of for loop
     f_means, f_vars = [], []
     for i, (kernel) in enumerate(kernel.kernels):
-        if len(q_sqrt.shape) == 2:
-            q_sqrt_i = q_sqrt[:, i : i + 1]
-        elif len(q_sqrt.shape) == 3:
-            q_sqrt_i = q_sqrt[i : i + 1, :, :]
-        f_mean, f_var = uncertain_conditional(
+        f_mean, f_var = uncertain_conditional_prepared(
             input_mean,
             input_var,
             inducing_variables,
             # gp.inducing_variable.inducing_variables[0],
             kernel=kernel,
-            q_mu=q_mu[:, i : i + 1],
-            q_sqrt=q_sqrt_i,
+            cache=cache[i],
             mean_function=mean_function,
             full_output_cov=full_output_cov,
             full_cov=full_cov,
-            white=whiten,
         )
         f_means.append(f_mean)
         f_vars.append(f_var)
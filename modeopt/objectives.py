@@ -15,7 +15,10 @@ from modeopt.cost_functions import (
 )
 from modeopt.custom_types import State, StateDim
 from modeopt.dynamics import ModeOptDynamics, SVGPDynamicsWrapper
-from modeopt.dynamics.conditionals import svgp_covariance_conditional
+from modeopt.dynamics.conditionals import (
+    prepare_svgp_context,
+    svgp_covariance_conditional,
+)
 from modeopt.mode_opt import ModeOpt
 from modeopt.rollouts import rollout_controls_in_dynamics
 from modeopt.utils import combine_state_controls_to_input
@@ -146,27 +149,32 @@ def build_explorative_objective(
             #         control_vars=control_vars,
         )
 
-        h_means_prior, h_vars_prior = dynamics.uncertain_predict_gating(
-            state_means[1:, :], control_means
-        )
-        gating_gp = dynamics.desired_mode_gating_gp
-
         input_means, input_vars = combine_state_controls_to_input(
             state_means[1:, :],
             control_means,
             state_vars[1:, :],
             control_vars,
         )
+        # reuse the concatenated inputs (prior ignores the state-control variance)
+        h_means_prior, h_vars_prior = dynamics.uncertain_predict_gating_given_input(
+            input_means
+        )
+        gating_gp = dynamics.desired_mode_gating_gp
+
+        # Posterior covariance between every pair of time steps in one call (with
+        # K(Z, Z) factorised once), sliced below instead of 3 calls per time step
+        gating_context = prepare_svgp_context(gating_gp)
+        K = svgp_covariance_conditional(
+            X1=input_means, X2=input_means, svgp=gating_gp, context=gating_context
+        )[0, :, :]
 
         h_means, h_vars = h_means_prior[0:1, :], h_vars_prior[0:1, :]
         for t in range(1, initial_solution.horizon):
-            Xnew = input_means[t : t + 1, :]
-            Xobs = input_means[0:t, :]
             f = h_means_prior[0:t, :]
 
-            Knn = svgp_covariance_conditional(X1=Xnew, X2=Xnew, svgp=gating_gp)[0, 0, :]
-            Kmm = svgp_covariance_conditional(X1=Xobs, X2=Xobs, svgp=gating_gp)[0, :, :]
-            Kmn = svgp_covariance_conditional(X1=Xobs, X2=Xnew, svgp=gating_gp)[0, :, :]
+            Knn = K[t : t + 1, t]
+            Kmm = K[0:t, 0:t]
+            Kmn = K[0:t, t : t + 1]
             Kmm += tf.eye(Kmm.shape[0], dtype=default_float()) * default_jitter()
             # Lm = tf.linalg.cholesky(Kmm)
             # A = tf.linalg.triangular_solve(Lm, Kmn, lower=True)  # [..., M, N]
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import typing
-from typing import Tuple, Union
+from typing import Callable, NamedTuple, Tuple, Union
 
 import numpy as np
 import tensor_annotations.tensorflow as ttf
@@ -13,7 +13,8 @@ from tf_agents.environments import py_environment
 from modeopt.dynamics import SVGPDynamicsWrapper, ModeOptDynamics
 from modeopt.controllers import NonFeedbackController, FeedbackController
 
-from modeopt.custom_types import StateDim, ControlDim, Horizon, One, Dataset
+from modeopt.custom_types import StateDim, ControlDim, Horizon, InputDim, One, Dataset
+from modeopt.utils import combine_state_controls_to_input
 
 HorizonPlusOne = typing.NewType("HorizonPlusOne", axes.Axis)
 Controller = Union[FeedbackController, NonFeedbackController]
@@ -33,28 +34,42 @@ def rollout_policy_controller_in_dynamics(
 
     :returns: (states_means, state_vars)
     """
+    horizon = controller.horizon
+    state_dim = start_state.shape[-1]
+    state_mean = tf.reshape(start_state, [1, state_dim])
     if start_state_var is None:
-        if len(start_state.shape) == 2:
-            start_state_var = tf.zeros((1, start_state.shape[1]), dtype=default_float())
-        else:
-            start_state_var = tf.zeros((1, start_state.shape[0]), dtype=default_float())
-
-    state_means = start_state
-    state_vars = start_state_var
-    controls = []
-    for t in range(controller.horizon):
-        control = controller(state_means[-1, :], t)
-        next_state_mean, next_state_var = dynamics.forward(
-            state_mean=state_means[-1:, :],
+        state_var = tf.zeros((1, state_dim), dtype=default_float())
+    else:
+        state_var = tf.reshape(start_state_var, [1, state_dim])
+
+    state_means = tf.TensorArray(
+        default_float(), size=horizon + 1, element_shape=[1, state_dim]
+    )
+    state_vars = tf.TensorArray(
+        default_float(), size=horizon + 1, element_shape=[1, state_dim]
+    )
+    controls = tf.TensorArray(default_float(), size=horizon)
+    state_means = state_means.write(0, state_mean)
+    state_vars = state_vars.write(0, state_var)
+    cache = dynamics.prepare_cache()  # Cholesky of Kuu etc are fixed during rollout
+    for t in range(horizon):
+        control = controller(state_mean[0, :], t)
+        state_mean, state_var = dynamics.forward(
+            state_mean=state_mean,
             control_mean=control,
-            state_var=state_vars[-1:, :],
+            state_var=state_var,
             control_var=None,
             predict_state_difference=False,
+            cache=cache,
         )
-        controls.append(control)
-        state_means = tf.concat([state_means, next_state_mean], 0)
-        state_vars = tf.concat([state_vars, next_state_var], 0)
-    return state_means, state_vars, tf.concat(controls, 0)
+        controls = controls.write(t, control)
+        state_means = state_means.write(t + 1, state_mean)
+        state_vars = state_vars.write(t + 1, state_var)
+    return (
+        state_means.stack()[:, 0, :],
+        state_vars.stack()[:, 0, :],
+        controls.concat(),
+    )
 
 
 def rollout_controller_in_dynamics(
@@ -85,15 +100,6 @@ def rollout_controller_in_dynamics(
 
     if not variance:
         control_vars = None
-    means, var = rollout_controls_in_dynamics(
-        dynamics=dynamics,
-        start_state=start_state,
-        control_means=control_means,
-        control_vars=control_vars,
-    )
-    # print("state means ROLLOUT")
-    # print(means)
-    # print(vars)
     return rollout_controls_in_dynamics(
         dynamics=dynamics,
         start_state=start_state,
@@ -121,14 +127,16 @@ def rollout_controller_in_env(
             env=env, start_state=start_state, controls=controls
         )
     else:
-        states = tf.identity(start_state)
-        env.state_init = states
+        start_state = np.asarray(start_state)
+        env.state_init = start_state
         env.reset()
 
+        states = np.empty((controller.horizon + 1, start_state.shape[-1]))
+        states[0] = start_state.reshape(-1)
         for t in range(controller.horizon):
-            next_time_step = env.step(controller(states[-1, :], t))
-            states = tf.concat([states, next_time_step.observation], axis=0)
-        return tf.stack(states)
+            next_time_step = env.step(controller(states[t], t))
+            states[t + 1] = np.reshape(next_time_step.observation, -1)
+        return states
 
 
 def rollout_controls_in_dynamics(
@@ -142,61 +150,154 @@ def rollout_controls_in_dynamics(
 ]:
     """Rollout a given set of control means and vars
 
+    :returns: (states_means, state_vars)
+    """
+    state_dim = start_state.shape[-1]
+    if start_state_var is not None:
+        start_state_var = tf.reshape(start_state_var, [1, state_dim])
+    if control_vars is not None:
+        control_vars = control_vars[:, None, :]
+    state_means, state_vars = rollout_controls_in_dynamics_batched(
+        dynamics=dynamics,
+        start_states=tf.reshape(start_state, [1, state_dim]),
+        control_means=control_means[:, None, :],
+        start_state_vars=start_state_var,
+        control_vars=control_vars,
+    )
+    return state_means[:, 0, :], state_vars[:, 0, :]
+
+
+def rollout_controls_in_dynamics_batched(
+    dynamics: Union[SVGPDynamicsWrapper, ModeOptDynamics],
+    start_states: ttf.Tensor2[Batch, StateDim],
+    control_means: ttf.Tensor3[Horizon, Batch, ControlDim],
+    start_state_vars: ttf.Tensor2[Batch, StateDim] = None,
+    control_vars: ttf.Tensor3[Horizon, Batch, ControlDim] = None,
+) -> Tuple[
+    ttf.Tensor3[HorizonPlusOne, Batch, StateDim],
+    ttf.Tensor3[HorizonPlusOne, Batch, StateDim],
+]:
+    """Rollout a batch of independent control trajectories in parallel
+
+    Each dynamics call predicts the next state for the whole batch, so the per step
+    overhead (kernel expectations, solves etc) is shared by the batch of rollouts.
+    The rollout is a tf.while_loop writing each step into preallocated TensorArrays,
+    so inside a tf.function it traces to a single loop.
+
     :returns: (states_means, state_vars)
     """
     horizon = control_means.shape[0]
-    if start_state_var is None:
-        if len(start_state.shape) == 2:
-            start_state_var = tf.zeros((1, start_state.shape[1]), dtype=default_float())
-        else:
-            start_state_var = tf.zeros((1, start_state.shape[0]), dtype=default_float())
+    state_dim = start_states.shape[-1]
+    if start_state_vars is None:
+        start_state_vars = tf.zeros(tf.shape(start_states), dtype=default_float())
+    if control_vars is None:
+        # allocate once instead of the dynamics building zeros at every step
+        control_vars = tf.zeros(tf.shape(control_means), dtype=default_float())
+
+    # the batch dim may only be known at run time (e.g. a [None, D] input_signature)
+    state_means = tf.TensorArray(
+        default_float(), size=horizon + 1, element_shape=start_states.shape
+    )
+    state_vars = tf.TensorArray(
+        default_float(), size=horizon + 1, element_shape=start_states.shape
+    )
+    state_means = state_means.write(0, start_states)
+    state_vars = state_vars.write(0, start_state_vars)
+    cache = dynamics.prepare_cache()  # Cholesky of Kuu etc are fixed during rollout
 
-    state_means = start_state
-    state_vars = start_state_var
-    for t in range(horizon):
-        control_mean = control_means[t : t + 1, :]
-        if control_vars is not None:
-            control_var = control_vars[t : t + 1, :]
-        else:
-            control_var = None
+    def body(t, state_mean, state_var, state_means, state_vars):
+        control_mean = tf.gather(control_means, t)
+        control_var = tf.gather(control_vars, t)
         next_state_mean, next_state_var = dynamics.forward(
-            state_mean=state_means[-1:, :],
+            state_mean=state_mean,
             control_mean=control_mean,
-            state_var=state_vars[-1:, :],
+            state_var=state_var,
             control_var=control_var,
             predict_state_difference=False,
+            cache=cache,
+        )
+        return (
+            t + 1,
+            next_state_mean,
+            next_state_var,
+            state_means.write(t + 1, next_state_mean),
+            state_vars.write(t + 1, next_state_var),
         )
-        state_means = tf.concat([state_means, next_state_mean], 0)
-        state_vars = tf.concat([state_vars, next_state_var], 0)
-    return state_means, state_vars
 
+    # the carried states may come back from the dynamics without a static batch dim
+    state_shape = tf.TensorShape([None, state_dim])
+    _, _, _, state_means, state_vars = tf.while_loop(
+        lambda t, *_: t < horizon,
+        body,
+        loop_vars=(
+            tf.constant(0),
+            start_states,
+            start_state_vars,
+            state_means,
+            state_vars,
+        ),
+        shape_invariants=(
+            tf.TensorShape([]),
+            state_shape,
+            state_shape,
+            tf.TensorShape(None),
+            tf.TensorShape(None),
+        ),
+        maximum_iterations=horizon,
+    )
+    return state_means.stack(), state_vars.stack()
 
-# def rollout_policy_in_dynamics(
-#     policy: VariationalPolicy,
-#     dynamics: SVGPDynamicsWrapper,
-#     start_state: ttf.Tensor2[One, StateDim],
-#     start_state_var: ttf.Tensor2[One, StateDim] = None,
-# ) -> Tuple[
-#     ttf.Tensor2[HorizonPlusOne, StateDim], ttf.Tensor2[HorizonPlusOne, StateDim]
-# ]:
-#     """Rollout a policy in gp dynamics model
-
-#     :returns: (states_means, state_vars)
-#     """
-#     raise DeprecationWarning()
-#     # if start_state_var is None:
-#     #     start_state_var = tf.zeros((1, start_state.shape[1]), dtype=default_float())
-
-#     # state_means = start_state
-#     # state_vars = start_state_var
-#     # for t in range(policy.num_time_steps):
-#     #     control_mean, control_var = policy(t)
-#     #     next_state_mean, next_state_var = dynamics(
-#     #         state_means[-1:, :], control_mean, state_vars[-1:, :], control_var
-#     #     )
-#     #     state_means = tf.concat([state_means, next_state_mean], 0)
-#     #     state_vars = tf.concat([state_vars, next_state_var], 0)
-#     # return state_means, state_vars
+
+class RolloutResult(NamedTuple):
+    """Rollout of a policy along with the slices/concats its consumers need"""
+
+    state_means: ttf.Tensor2[HorizonPlusOne, StateDim]
+    state_vars: ttf.Tensor2[HorizonPlusOne, StateDim]
+    control_means: ttf.Tensor2[Horizon, ControlDim]
+    control_vars: ttf.Tensor2[Horizon, ControlDim]
+    sm: ttf.Tensor2[Horizon, StateDim]  # states the controls are applied at
+    sv: ttf.Tensor2[Horizon, StateDim]
+    input_means: ttf.Tensor2[Horizon, InputDim]  # [sm, control_means]
+    input_vars: ttf.Tensor2[Horizon, InputDim]  # [sv, control_vars]
+
+
+def rollout_policy_in_dynamics(
+    policy: Callable[
+        [], Tuple[ttf.Tensor2[Horizon, ControlDim], ttf.Tensor2[Horizon, ControlDim]]
+    ],
+    dynamics: Union[SVGPDynamicsWrapper, ModeOptDynamics],
+    start_state: ttf.Tensor2[One, StateDim],
+    start_state_var: ttf.Tensor2[One, StateDim] = None,
+) -> RolloutResult:
+    """Rollout a (non feedback) policy in gp dynamics model
+
+    The policy's controls don't depend on the state so they are computed upfront and
+    rolled out with the TensorArray/tf.while_loop in rollout_controls_in_dynamics.
+    The slices/concats used by the objectives are built once here (unused ones are
+    pruned from the graph).
+    """
+    control_means, control_vars = policy()
+    state_means, state_vars = rollout_controls_in_dynamics(
+        dynamics=dynamics,
+        start_state=start_state,
+        control_means=control_means,
+        start_state_var=start_state_var,
+        control_vars=control_vars,
+    )
+    sm, sv = state_means[:-1, :], state_vars[:-1, :]
+    input_means, input_vars = combine_state_controls_to_input(
+        sm, control_means, state_var=sv, control_var=control_vars
+    )
+    return RolloutResult(
+        state_means=state_means,
+        state_vars=state_vars,
+        control_means=control_means,
+        control_vars=control_vars,
+        sm=sm,
+        sv=sv,
+        input_means=input_means,
+        input_vars=input_vars,
+    )
 
 
 def rollout_controls_in_env(
@@ -208,15 +309,17 @@ def rollout_controls_in_env(
 
     :returns: states
     """
-    states = tf.identity(start_state)
-    env.state_init = states
+    start_state = np.asarray(start_state)
+    env.state_init = start_state
     env.reset()
     horizon = controls.shape[0]
 
+    states = np.empty((horizon + 1, start_state.shape[-1]))
+    states[0] = start_state.reshape(-1)
     for t in range(horizon):
         next_time_step = env.step(controls[t])
-        states = tf.concat([states, next_time_step.observation], axis=0)
-    return tf.stack(states)
+        states[t + 1] = np.reshape(next_time_step.observation, -1)
+    return states
 
 
 # def rollout_policy_in_env(
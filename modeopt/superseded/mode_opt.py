@@ -152,9 +152,10 @@ class ModeOpt(Module):
         )
 
     def dynamics_rollout(self, start_state, start_state_var=None):
-        return rollout_policy_in_dynamics(
+        rollout = rollout_policy_in_dynamics(
             self.policy, self.dynamics, start_state, start_state_var=start_state_var
         )
+        return rollout.state_means, rollout.state_vars
 
     def env_rollout(self, start_state):
         return rollout_policy_in_env(self.env, self.policy, start_state=start_state)
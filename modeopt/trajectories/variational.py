@@ -24,6 +24,10 @@ class ControlTrajectoryDist(BaseTrajectory):
 
     dist: Union[tfd.MultivariateNormalDiag, tfd.Deterministic]  # [horizon, control_dim]
 
+    def __post_init__(self):
+        # static so cache them instead of building dist.mean() on every access
+        self._horizon, self._control_dim = self.dist.loc.shape
+
     def __call__(
         self, timestep: Optional[int] = None, variance: Optional[bool] = False
     ) -> Union[ControlTrajectory, ControlTrajectoryMean]:
@@ -50,6 +54,14 @@ class ControlTrajectoryDist(BaseTrajectory):
     def control_vars(self):
         return self.dist.variance()
 
+    @property
+    def horizon(self) -> int:
+        return self._horizon
+
+    @property
+    def control_dim(self) -> int:
+        return self._control_dim
+
     def copy(self):
         return ControlTrajectoryDist(self.dist.copy())
 
@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 import abc
 import typing
+import warnings
 from dataclasses import dataclass
 from typing import Callable
 
 import gpflow as gpf
 import tensor_annotations.tensorflow as ttf
 import tensorflow as tf
+import tensorflow_probability as tfp
 from modeopt.cost_functions import CostFunction
 from modeopt.dynamics import Dynamics
 from modeopt.policies import VariationalPolicy
+from scipy.optimize import OptimizeResult
 from tensor_annotations import axes
 from tensor_annotations.axes import Batch
 
@@ -25,11 +28,12 @@ class TrajectoryOptimiserTrainingSpec:
     """
 
     max_iterations: int = 100
-    method: str = "SLSQP"
+    method: str = "SLSQP"  # scipy method or "LBFGS" for in graph tfp L-BFGS
     disp: bool = True
     compile_loss_fn: bool = True  # loss function in tf.function?
     monitor: gpf.monitor.Monitor = None
     manager: tf.train.CheckpointManager = None
+    save_every: int = 10  # save a checkpoint every save_every steps
     cost_fn: CostFunction = None
 
 
@@ -62,6 +66,12 @@ class TrajectoryOptimiser(abc.ABC):
         self.control_dim = self.policy.control_dim
 
         self._objective_closure = None
+        self._start_state = None
+        # objective closures (and their start state variables) so repeated calls to
+        # optimise reuse the traced objective instead of retracing
+        self._objective_cache = {}
+        self._lbfgs_cache = {}  # and their L-BFGS loops (same keys)
+        self._callback, self._callback_key = None, None
 
     def optimise(
         self,
@@ -70,43 +80,61 @@ class TrajectoryOptimiser(abc.ABC):
         constraints=[],
     ):
         """Optimise trajectories starting from an initial state"""
-        if training_spec.monitor and training_spec.manager:
-
-            def callback(step, variables, values):
-                training_spec.monitor(step)
-                training_spec.manager.save()
-
-        elif training_spec.monitor is not None:
-
-            def callback(step, variables, values):
-                training_spec.monitor(step)
-
-        elif training_spec.manager is not None:
-
-            def callback(step, variables, values):
-                training_spec.manager.save()
+        callback = self._build_callback(training_spec)
 
+        key = (
+            tuple(start_state.shape),
+            tf.as_dtype(start_state.dtype),
+            training_spec.compile_loss_fn,
+        )
+        if key in self._objective_cache:
+            self._objective_closure, self._start_state = self._objective_cache[key]
+            self._start_state.assign(start_state)
         else:
-            callback = None
-
-        if self.objective_closure is None:
             self.build_objective(start_state, compile=training_spec.compile_loss_fn)
+            self._objective_cache[key] = (self._objective_closure, self._start_state)
 
         policy_variables = [
             param.unconstrained_variable for param in self.policy.trainable_parameters
         ]
 
-        optimisation_result = self.optimiser.minimize(
-            self.objective_closure,
-            policy_variables,
-            method=training_spec.method,
-            constraints=constraints,
-            step_callback=callback,
-            options={
-                "disp": training_spec.disp,
-                "maxiter": training_spec.max_iterations,
-            },
-        )
+        method = training_spec.method
+        if method == "LBFGS" and constraints:
+            warnings.warn("LBFGS can't handle constraints, falling back to SLSQP")
+            method = "SLSQP"
+        if method == "LBFGS":
+            optimisation_result = self._lbfgs_minimize(
+                policy_variables, training_spec, key
+            )
+        else:
+            # Scipy uses jac=True with the closure's GradientTape gradients (not finite
+            # differences), compile so the value and gradients are one tf.function call
+            optimisation_result = self.optimiser.minimize(
+                self.objective_closure,
+                policy_variables,
+                method=method,
+                constraints=constraints,
+                step_callback=callback,
+                compile=training_spec.compile_loss_fn,
+                options={
+                    "disp": training_spec.disp,
+                    "maxiter": training_spec.max_iterations,
+                },
+            )
+        if training_spec.manager is not None:
+            # the step callback only saves every save_every steps
+            training_spec.manager.save()
+        if training_spec.compile_loss_fn:
+            # L-BFGS traces the objective inside its own loop, so count the loop's
+            # traces instead (the objective's count includes the nested trace)
+            if method == "LBFGS":
+                compiled_fn = self._lbfgs_cache[key]
+            else:
+                compiled_fn = self.objective_closure
+            if compiled_fn.experimental_get_tracing_count() > 1:
+                warnings.warn(
+                    "Objective was retraced during optimisation, every retrace recompiles"
+                )
         print("Optimisation result:")
         print(optimisation_result)
         print("self.policy.trainable_variables")
@@ -118,14 +146,120 @@ class TrajectoryOptimiser(abc.ABC):
         print(self.policy.variational_dist.variance())
         return optimisation_result
 
+    def _lbfgs_minimize(
+        self,
+        variables: typing.List[tf.Variable],
+        training_spec: TrajectoryOptimiserTrainingSpec,
+        key: tuple,
+    ) -> OptimizeResult:
+        """Minimise the objective with tfp's L-BFGS (unconstrained)
+
+        Unlike Scipy, the optimisation loop runs in the TensorFlow graph so there is no
+        round trip to numpy every iteration. There is no step callback, the monitor is
+        called once it finishes (and optimise saves the checkpoint). The results are
+        returned as a scipy OptimizeResult, like the Scipy methods.
+        """
+        if key not in self._lbfgs_cache:
+            self._lbfgs_cache[key] = self._build_lbfgs_minimize(
+                variables, compile=training_spec.compile_loss_fn
+            )
+        minimize = self._lbfgs_cache[key]
+
+        if training_spec.monitor is not None or training_spec.manager is not None:
+            warnings.warn(
+                "LBFGS runs in graph, the monitor/checkpoint only run after it finishes"
+            )
+        results = minimize(tf.constant(training_spec.max_iterations))
+        converged = bool(results.converged)
+        result = OptimizeResult(
+            x=results.position.numpy(),
+            fun=results.objective_value.numpy(),
+            jac=results.objective_gradient.numpy(),
+            nit=int(results.num_iterations),
+            nfev=int(results.num_objective_evaluations),
+            success=converged,
+            status=0 if converged else 1,
+            message="Converged" if converged else "Did not converge",
+        )
+        if training_spec.monitor is not None:
+            training_spec.monitor(result.nit)
+        if training_spec.disp:
+            print("L-BFGS: {}".format(result.message))
+            print("    Current function value: {}".format(result.fun))
+            print("    Iterations: {}".format(result.nit))
+            print("    Function evaluations: {}".format(result.nfev))
+        return result
+
+    def _build_lbfgs_minimize(
+        self, variables: typing.List[tf.Variable], compile: bool = False
+    ) -> Callable:
+        """L-BFGS loop for the current objective closure, traced once when compiled"""
+        objective = self._objective_closure
+        sizes = [variable.shape.num_elements() for variable in variables]
+
+        def assign_flat(position):
+            for variable, flat in zip(variables, tf.split(position, sizes)):
+                variable.assign(tf.reshape(flat, variable.shape))
+
+        def value_and_gradients(position):
+            assign_flat(position)
+            with tf.GradientTape() as tape:
+                loss = objective()
+            gradients = tape.gradient(loss, variables)
+            return loss, tf.concat([tf.reshape(g, [-1]) for g in gradients], 0)
+
+        if compile:
+            value_and_gradients = tf.function(value_and_gradients)
+
+        def minimize(max_iterations):
+            results = tfp.optimizer.lbfgs_minimize(
+                value_and_gradients,
+                initial_position=tf.concat([tf.reshape(v, [-1]) for v in variables], 0),
+                max_iterations=max_iterations,
+            )
+            assign_flat(results.position)
+            return results
+
+        if compile:
+            # max_iterations is a tensor so changing it doesn't retrace
+            minimize = tf.function(minimize)
+        return minimize
+
+    def _build_callback(self, training_spec: TrajectoryOptimiserTrainingSpec):
+        """Step callback (rebuilt only if the spec changes), checkpoints throttled"""
+        monitor, manager = training_spec.monitor, training_spec.manager
+        save_every = training_spec.save_every
+        callback_key = (id(monitor), id(manager), save_every)
+        if self._callback_key != callback_key:
+            if monitor is None and manager is None:
+                callback = None
+            else:
+
+                def callback(step, variables, values):
+                    if monitor is not None:
+                        monitor(step)
+                    if manager is not None and step % save_every == 0:
+                        manager.save()
+
+            self._callback, self._callback_key = callback, callback_key
+        return self._callback
+
     def build_objective(
         self, start_state: ttf.Tensor2[Batch, StateDim], compile: bool = False
     ) -> Callable:
+        # read from a variable so the closure can be reused for new start states
+        self._start_state = tf.Variable(start_state, trainable=False)
+        start_state = self._start_state
+
         def objective():
             return -self.objective(start_state)
 
         if compile:
+            # no arguments (everything is captured) so trace it once here, when built.
+            # Not XLA compiled, the gradients of the jit_compile conditionals inside the
+            # rollout's while_loop don't have compile-time constant shapes
             objective = tf.function(objective)
+            objective.get_concrete_function()
         self._objective_closure = objective
         return self._objective_closure
 
@@ -3,14 +3,11 @@ import typing
 from dataclasses import dataclass
 
 import gpflow as gpf
+import numpy as np
 import tensor_annotations.tensorflow as ttf
 import tensorflow as tf
 import tensorflow_probability as tfp
-from gpflow import default_float
-from modeopt.cost_functions import (
-    CostFunction,
-    quadratic_cost_fn,
-)
+from modeopt.cost_functions import CostFunction
 from modeopt.dynamics import GPDynamics
 from modeopt.policies import VariationalPolicy
 from modeopt.rollouts import rollout_policy_in_dynamics
@@ -23,19 +20,26 @@ tfd = tfp.distributions
 StateDim = typing.NewType("StateDim", axes.Axis)
 ControlDim = typing.NewType("ControlDim", axes.Axis)
 
+# constant in the approximation of the binary entropy of a probit(h)
+ENTROPY_APPROX_C = float(np.sqrt(np.pi * np.log(2.0) / 2.0))
+# objective constants, python floats (not tf.constants) so they take the dtype of the
+# tensors they meet and trace to Const ops XLA folds, whatever default_float is later
+DEFAULT_TARGET_MODE_PROB = 0.7
+LENGTH_WEIGHT = 0.001  # weight of the euclidean length of the trajectory
+
 
 def binary_entropy(probs):
-    return -probs * tf.math.log(probs) - (1 - probs) * tf.math.log(1 - probs)
+    # xlogy(0, 0) = 0 so probs of exactly 0 or 1 don't give NaNs (or NaN gradients)
+    return -(tf.math.xlogy(probs, probs) + tf.math.xlogy(1 - probs, 1 - probs))
 
 
 def entropy_approx(h_means, h_vars, mode_probs):
-    C = tf.constant(np.sqrt(math.pi * np.log(2.0) / 2.0), dtype=default_float())
-    param_entropy = C * tf.exp(-(h_means ** 2) / (2 * (h_vars ** 2 + C ** 2)))
-    param_entropy = param_entropy / (tf.sqrt(h_vars ** 2 + C ** 2))
-    print("param_entropy")
-    print(param_entropy)
+    C = ENTROPY_APPROX_C
+    denom = h_vars * h_vars + C * C
+    param_entropy = (
+        C * tf.exp(-0.5 * h_means * h_means / denom) * tf.math.rsqrt(denom)
+    )
     model_entropy = binary_entropy(mode_probs)
-    print(model_entropy)
     return model_entropy - param_entropy
 
 
@@ -47,13 +51,14 @@ class ExplorativeTrajectoryOptimiserTrainingSpec:
     """
 
     max_iterations: int = 100
-    method: str = "SLSQP"
+    method: str = "SLSQP"  # scipy method or "LBFGS" for in graph tfp L-BFGS
     disp: bool = True
     mode_chance_constraint_lower: float = None  # lower bound on mode probability over traj, set as None to turn off mode constraints
     compile_mode_constraint_fn: bool = True  # constraints fn in tf.function?
     compile_loss_fn: bool = True  # loss function in tf.function?
     monitor: gpf.monitor.Monitor = None
     manager: tf.train.CheckpointManager = None
+    save_every: int = 10  # save a checkpoint every save_every steps
     cost_fn: CostFunction = None
 
 
@@ -63,138 +68,53 @@ class ExplorativeTrajectoryOptimiser(TrajectoryOptimiser):
         policy: VariationalPolicy,
         dynamics: GPDynamics,
         cost_fn: CostFunction,
+        target_mode_prob: float = DEFAULT_TARGET_MODE_PROB,
     ):
         super().__init__(
             policy=policy,
             dynamics=dynamics,
             cost_fn=cost_fn,
         )
+        # mode probability the trajectory is pushed towards
+        self._target_mode_prob = float(target_mode_prob)
 
     def objective(
         self,
         start_state: ttf.Tensor2[Batch, StateDim],
         start_state_var: ttf.Tensor2[Batch, StateDim] = None,
     ):
-        """Optimise trajectories starting from an initial state"""
-        entropy = self.policy.entropy()  # calculate entropy of policy dist
+        """Optimise trajectories starting from an initial state
 
+        Only the terms in J are computed (the policy entropy, expected costs and mode
+        variational expectation were unused but each added GP predictions/gradients).
+        """
         # Rollout controls in dynamics
-        state_means, state_vars = rollout_policy_in_dynamics(
+        r = rollout_policy_in_dynamics(
             self.policy,
             self.dynamics,
             start_state,
             start_state_var=start_state_var,
         )
+        sm = r.sm  # states the controls are applied at [Horizon, StateDim]
+        control_means = r.control_means
 
-        # Calculate costs
-        control_means, control_vars = self.policy()
-        expected_costs = self.cost_fn(
-            state=state_means,
-            control=control_means,
-            state_var=state_vars,
-            control_var=control_vars,
-        )
-        print("expected_cost")
-        print(expected_costs)
-        # expected_integral_costs, expected_terminal_cost = expected_quadratic_costs(
-        #     cost_fn=self.cost_fn,
-        #     terminal_cost_fn=self.terminal_cost_fn,
-        #     state_means=state_means,
-        #     state_vars=state_vars,
-        #     policy=self.policy,
-        # )  # [Batch,], []
-
-        # self.dynamics.predict_mode_probability_given_latent(
-        #     h_mean=gating_means, h_var=gating_vars
-        # )
-        # predict_mode_probability(state_mean, control_mean, state_var, control_var)
-        # control_means, control_vars = self.policy()
-        mode_var_exp = self.dynamics.mode_variational_expectation(
-            state_means[:-1, :], control_means, state_vars[:-1, :], control_vars
-        )
-
-        # gating_means, gating_vars = self.dynamics.uncertain_predict_gating(
-        #     state_means[:-1, :], control_means, state_vars[:-1, :], control_vars
-        # )
-        gating_means, gating_vars = self.dynamics.uncertain_predict_gating(
-            state_means[:-1, :], control_means
-        )
-        gating_entropy_old = tfd.Normal(gating_means, gating_vars)
-        gating_entropy_old = gating_entropy_old.entropy()
-        gating_entropy_sum_old = tf.reduce_sum(gating_entropy_old)
-
-        gating_means, gating_vars = self.dynamics.gating_conditional_entropy(
-            state_means[:-1, :], control_means, state_vars[:-1, :], control_vars
-        )
-        gating_entropy = tfd.Normal(gating_means, gating_vars)
-        gating_entropy = gating_entropy.entropy()
-        tf.print("gating_entropy_old")
-        tf.print(gating_entropy_old)
-        tf.print("gating_entropy")
-        tf.print(gating_entropy)
-        gating_entropy_sum = tf.reduce_sum(gating_entropy)
-        tf.print("gating_entropy_sum")
-        tf.print(gating_entropy_sum)
-
-        tf.print(mode_var_exp)
-
-        probs = self.dynamics.predict_mode_probability(
-            state_means[:-1, :], control_means, state_vars[:-1, :], control_vars
+        # the rollout's concatenated [sm, control_means] inputs (and variances)
+        probs = self.dynamics.predict_mode_probability_given_input(
+            r.input_means, r.input_vars
         )
-        print("probs")
-        print(probs)
-        prob_errors = (probs - 0.7) ** 2
-        tf.print("prob_errors")
-        tf.print(prob_errors)
-        prob_errors_sum = tf.reduce_sum(prob_errors)
-        tf.print("prob_errors_sum")
-        tf.print(prob_errors_sum)
+        # sum of squared errors, l2_loss = sum(x ** 2) / 2
+        prob_errors_sum = 2.0 * tf.nn.l2_loss(probs - self._target_mode_prob)
 
         # manifold = GPManifold(self.dynamics.gating_gp, covariance_weight=0.05)
-        input_mean = tf.concat([state_means[:-1, :], control_means], -1)
-        input_var = tf.concat([state_vars[:-1, :], control_vars], -1)
-        velocities = input_mean[1:, :] - input_mean[:-1, :]
-        velocities_var = input_var[1:, :]
-        length_weight_matrix = (
-            tf.eye(velocities.shape[1], dtype=default_float()) * 0.001
-        )
-        print("length_weight_matrix")
-        print(length_weight_matrix)
-        euclidean_energy = tf.reduce_sum(
-            quadratic_cost_fn(
-                vector=velocities,
-                weight_matrix=length_weight_matrix,
-                vector_var=None,
-            )
+        # velocities of the state-control inputs [sm, control_means], the squared
+        # norm splits over the state/control dims so no concat is needed
+        state_velocities = sm[1:, :] - sm[:-1, :]
+        control_velocities = control_means[1:, :] - control_means[:-1, :]
+        # v^T (w I) v summed over the trajectory, without the [T, D] x [D, D] matmuls
+        euclidean_energy = LENGTH_WEIGHT * (
+            tf.reduce_sum(tf.square(state_velocities))
+            + tf.reduce_sum(tf.square(control_velocities))
         )
-        tf.print("euclidean_energy")
-        tf.print(euclidean_energy)
-
-        J = (
-            euclidean_energy
-            - prob_errors_sum
-            # -mode_var_exp * 0.1
-            # -mode_var_exp * 0.1
-            # -mode_var_exp * 0.05
-            # -expected_terminal_cost
-            # - tf.reduce_sum(expected_integral_costs)
-            # tf.reduce_sum(expected_integral_costs)
-            # + entropy
-            # + gating_entropy_sum_old
-            # + gating_entropy_sum
-            # gating_entropy_sum
-            # tf.reduce_sum(control_means)
-        )
-        tf.print("J")
-        tf.print(J)
-        tf.print("expected costs")
-        tf.print(-tf.reduce_sum(expected_integral_costs))
-        # print("mode_var_exp")
-        # print(mode_var_exp)
-        # print("expected_terminal_cost")
-        # print(expected_terminal_cost)
-        # print("expected_integral_cost")
-        # print(expected_integral_costs)
-        # print("entropy")
-        # print(entropy)
+
+        J = euclidean_energy - prob_errors_sum
         return J
@@ -9,10 +9,7 @@ from modeopt.cost_functions import CostFunction
 from modeopt.dynamics import GPDynamics
 from modeopt.policies import VariationalPolicy
 from modeopt.rollouts import rollout_policy_in_dynamics
-from modeopt.trajectory_optimisers.base import (
-    TrajectoryOptimiser,
-    TrajectoryOptimiserTrainingSpec,
-)
+from modeopt.trajectory_optimisers.base import TrajectoryOptimiser
 from tensor_annotations import axes
 from tensor_annotations.axes import Batch
 
@@ -28,13 +25,14 @@ class VariationalTrajectoryOptimiserTrainingSpec:
     """
 
     max_iterations: int = 100
-    method: str = "SLSQP"
+    method: str = "SLSQP"  # scipy method or "LBFGS" for in graph tfp L-BFGS
     disp: bool = True
     mode_chance_constraint_lower: float = None  # lower bound on mode probability over traj, set as None to turn off mode constraints
     compile_mode_constraint_fn: bool = True  # constraints fn in tf.function?
     compile_loss_fn: bool = True  # loss function in tf.function?
     monitor: gpf.monitor.Monitor = None
     manager: tf.train.CheckpointManager = None
+    save_every: int = 10  # save a checkpoint every save_every steps
     cost_fn: CostFunction = None
 
 
@@ -46,13 +44,14 @@ class ModeVariationalTrajectoryOptimiserTrainingSpec:
     """
 
     max_iterations: int = 100
-    method: str = "SLSQP"
+    method: str = "SLSQP"  # scipy method or "LBFGS" for in graph tfp L-BFGS
     disp: bool = True
     mode_chance_constraint_lower: float = None  # lower bound on mode probability over traj, set as None to turn off mode constraints
     compile_mode_constraint_fn: bool = True  # constraints fn in tf.function?
     compile_loss_fn: bool = True  # loss function in tf.function?
     monitor: gpf.monitor.Monitor = None
     manager: tf.train.CheckpointManager = None
+    save_every: int = 10  # save a checkpoint every save_every steps
     cost_fn: CostFunction = None
 
 
@@ -114,17 +113,14 @@ class VariationalTrajectoryOptimiser(TrajectoryOptimiser):
         entropy = self.policy.entropy()  # calculate entropy of policy dist
 
         # Rollout controls in dynamics
-        state_means, state_vars = rollout_policy_in_dynamics(
-            self.policy, self.dynamics, start_state
-        )
+        r = rollout_policy_in_dynamics(self.policy, self.dynamics, start_state)
 
         # Calculate costs
-        control_means, control_vars = self.policy()
         expected_costs = self.cost_fn(
-            state=state_means,
-            control=control_means,
-            state_var=state_vars,
-            control_var=control_vars,
+            state=r.state_means,
+            control=r.control_means,
+            state_var=r.state_vars,
+            control_var=r.control_vars,
         )
 
         elbo = -expected_costs + entropy
@@ -154,34 +150,21 @@ class ModeVariationalTrajectoryOptimiser(VariationalTrajectoryOptimiser):
         entropy = self.policy.entropy()  # calculate entropy of policy dist
 
         # Rollout controls in dynamics
-        state_means, state_vars = rollout_policy_in_dynamics(
-            self.policy, self.dynamics, start_state
-        )
+        r = rollout_policy_in_dynamics(self.policy, self.dynamics, start_state)
 
         # Calculate costs
-        control_means, control_vars = self.policy()
         expected_costs = self.cost_fn(
-            state=state_means,
-            control=control_means,
-            state_var=state_vars,
-            control_var=control_vars,
+            state=r.state_means,
+            control=r.control_means,
+            state_var=r.state_vars,
+            control_var=r.control_vars,
         )
 
         # Calulate variational expectation over mode indicator
-        mode_var_exp = self.dynamics.mode_variational_expectation(
-            state_means[:-1, :], control_means, state_vars[:-1, :], control_vars
+        mode_var_exp = self.dynamics.mode_variational_expectation_given_input(
+            r.input_means, r.input_vars
         )
 
-        tf.print("control_vars.min()")
-        tf.print(tf.reduce_min(control_vars))
-        tf.print("entropy")
-        tf.print(entropy)
-        tf.print("expected_costs")
-        tf.print(expected_costs)
-        tf.print("mode_var_exp")
-        tf.print(mode_var_exp)
         elbo = mode_var_exp - expected_costs + entropy / self.horizon
         # elbo = mode_var_exp - expected_costs
-        tf.print("elbo")
-        tf.print(elbo)
         return elbo
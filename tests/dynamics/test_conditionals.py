@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import gpflow
+import numpy as np
+import pytest
+import tensorflow as tf
+from gpflow.conditionals import uncertain_conditional as gpflow_uncertain_conditional
+from modeopt.dynamics.conditionals import (
+    base_covariance_conditional,
+    prepare_svgp_context,
+    svgp_covariance_conditional,
+    uncertain_conditional,
+)
+
+num_data = 5
+num_inducing = 20
+input_dim = 3
+output_dim = 2
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(42)
+
+
+@pytest.mark.parametrize("full_output_cov", [False, True])
+@pytest.mark.parametrize("white", [False, True])
+@pytest.mark.parametrize("mean_function", [None, "linear"])
+def test_uncertain_conditional_matches_gpflow(
+    full_output_cov, white, mean_function, rng
+):
+    kernel = gpflow.kernels.SquaredExponential(lengthscales=[1.0, 0.8, 1.3])
+    inducing_variable = gpflow.inducing_variables.InducingPoints(
+        rng.randn(num_inducing, input_dim)
+    )
+    q_mu = rng.randn(num_inducing, output_dim)
+    q_sqrt = 0.3 * np.tril(rng.randn(output_dim, num_inducing, num_inducing))
+    if mean_function == "linear":
+        mean_function = gpflow.mean_functions.Linear(
+            rng.randn(input_dim, output_dim), rng.randn(output_dim)
+        )
+    Xnew_mu = rng.randn(num_data, input_dim)
+    Xnew_var = 0.3 * rng.rand(num_data, input_dim)
+
+    kwargs = dict(
+        mean_function=mean_function, full_output_cov=full_output_cov, white=white
+    )
+    fmean, fvar = uncertain_conditional(
+        Xnew_mu, Xnew_var, inducing_variable, kernel, q_mu, q_sqrt, **kwargs
+    )
+    # gpflow's uncertain_conditional takes full input covariances
+    expected_fmean, expected_fvar = gpflow_uncertain_conditional(
+        Xnew_mu,
+        tf.linalg.diag(Xnew_var),
+        inducing_variable,
+        kernel,
+        q_mu,
+        q_sqrt,
+        **kwargs,
+    )
+    np.testing.assert_allclose(fmean, expected_fmean, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(fvar, expected_fvar, rtol=1e-8, atol=1e-10)
+
+
+def test_sliced_gating_covariances_match_per_step_calls(rng):
+    # the explorative objective slices one covariance over all time steps
+    gating_gp = gpflow.models.SVGP(
+        gpflow.kernels.SquaredExponential(lengthscales=[1.0, 0.8, 1.3]),
+        gpflow.likelihoods.Bernoulli(),
+        rng.randn(num_inducing, input_dim),
+        q_mu=rng.randn(num_inducing, 1),
+        q_sqrt=0.3 * np.tril(rng.randn(1, num_inducing, num_inducing)),
+    )
+    input_means = tf.constant(rng.randn(num_data, input_dim))
+    K = svgp_covariance_conditional(
+        X1=input_means,
+        X2=input_means,
+        svgp=gating_gp,
+        context=prepare_svgp_context(gating_gp),
+    )[0, :, :]
+
+    for t in range(1, num_data):
+        Xnew = input_means[t : t + 1, :]
+        Xobs = input_means[0:t, :]
+        Knn = svgp_covariance_conditional(X1=Xnew, X2=Xnew, svgp=gating_gp)[0, 0, :]
+        Kmm = svgp_covariance_conditional(X1=Xobs, X2=Xobs, svgp=gating_gp)[0, :, :]
+        Kmn = svgp_covariance_conditional(X1=Xobs, X2=Xnew, svgp=gating_gp)[0, :, :]
+        np.testing.assert_allclose(K[t : t + 1, t], Knn)
+        np.testing.assert_allclose(K[0:t, 0:t], Kmm)
+        np.testing.assert_allclose(K[0:t, t : t + 1], Kmn)
+
+
+@pytest.mark.parametrize("num_data_1, num_data_2", [(2, 7), (7, 2), (4, 4)])
+def test_base_covariance_conditional_association(num_data_1, num_data_2, rng):
+    # N1 < N2 and N2 < N1 associate the q_sqrt term differently to N1 == N2
+    kernel = gpflow.kernels.SquaredExponential(lengthscales=[1.0, 0.8, 1.3])
+    Z = rng.randn(num_inducing, input_dim)
+    X1 = rng.randn(num_data_1, input_dim)
+    X2 = rng.randn(num_data_2, input_dim)
+    f = rng.randn(num_inducing, output_dim)
+    q_sqrt = 0.3 * np.tril(rng.randn(output_dim, num_inducing, num_inducing))
+    Km1, Km2, K12 = kernel(Z, X1).numpy(), kernel(Z, X2).numpy(), kernel(X1, X2)
+    Lm = np.linalg.cholesky(kernel(Z).numpy() + 1e-6 * np.eye(num_inducing))
+
+    fcov = base_covariance_conditional(
+        Km1=Km1, Km2=Km2, Lm=Lm, K12=K12, f=f, q_sqrt=q_sqrt, white=True
+    )
+    A1, A2 = np.linalg.solve(Lm, Km1), np.linalg.solve(Lm, Km2)
+    LTA1 = np.transpose(q_sqrt, [0, 2, 1]) @ A1  # [R, M, N1]
+    LTA2 = np.transpose(q_sqrt, [0, 2, 1]) @ A2  # [R, M, N2]
+    expected_fcov = K12 - A1.T @ A2 + np.transpose(LTA1, [0, 2, 1]) @ LTA2
+    np.testing.assert_allclose(fcov, expected_fcov, rtol=1e-8, atol=1e-10)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+from types import SimpleNamespace
+
+import gpflow
+import numpy as np
+import pytest
+import tensorflow as tf
+from modeopt.dynamics import ModeOptDynamics
+from modeopt.rollouts import (
+    rollout_controls_in_dynamics,
+    rollout_controls_in_dynamics_batched,
+    rollout_policy_in_dynamics,
+)
+
+horizon = 5
+num_rollouts = 3
+state_dim = 2
+control_dim = 1
+num_inducing = 6
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(42)
+
+
+def svgp_expert(rng):
+    input_dim = state_dim + control_dim
+    kernel = gpflow.kernels.SeparateIndependent(
+        [gpflow.kernels.SquaredExponential() for _ in range(state_dim)]
+    )
+    inducing_variable = gpflow.inducing_variables.SharedIndependentInducingVariables(
+        gpflow.inducing_variables.InducingPoints(rng.randn(num_inducing, input_dim))
+    )
+    q_sqrt = 0.1 * np.tril(rng.randn(state_dim, num_inducing, num_inducing))
+    return gpflow.models.SVGP(
+        kernel,
+        gpflow.likelihoods.Gaussian(),
+        inducing_variable,
+        num_latent_gps=state_dim,
+        q_mu=rng.randn(num_inducing, state_dim),
+        q_sqrt=q_sqrt,
+    )
+
+
+@pytest.fixture
+def dynamics(rng):
+    # only the attributes of mogpe's MixtureOfSVGPExperts that the rollouts use
+    gating_gp = gpflow.models.SVGP(
+        gpflow.kernels.SquaredExponential(),
+        gpflow.likelihoods.Bernoulli(),
+        rng.randn(num_inducing, state_dim + control_dim),
+    )
+    mosvgpe = SimpleNamespace(
+        num_experts=2,
+        experts_list=[SimpleNamespace(gp=svgp_expert(rng)) for _ in range(2)],
+        gating_network=SimpleNamespace(gp=gating_gp, num_gating_gps=1),
+    )
+    return ModeOptDynamics(mosvgpe, state_dim=state_dim, desired_mode=1)
+
+
+def test_rollout_policy_in_dynamics_traces(dynamics, rng):
+    start_state = tf.constant(rng.randn(1, state_dim))
+    controls = (
+        tf.constant(rng.randn(horizon, control_dim)),
+        tf.constant(0.1 * rng.rand(horizon, control_dim)),
+    )
+
+    def objective():
+        r = rollout_policy_in_dynamics(lambda: controls, dynamics, start_state)
+        return r.state_means, r.state_vars
+
+    compiled_objective = tf.function(objective)
+    concrete_objective = compiled_objective.get_concrete_function()
+    for output in concrete_objective.structured_outputs:
+        assert output.shape == (horizon + 1, state_dim)
+
+    for compiled, expected in zip(compiled_objective(), objective()):
+        np.testing.assert_allclose(compiled, expected)
+
+
+def test_rollout_controls_in_dynamics_batched_matches_separate_rollouts(dynamics, rng):
+    start_states = tf.constant(rng.randn(num_rollouts, state_dim))
+    start_state_vars = tf.constant(0.1 * rng.rand(num_rollouts, state_dim))
+    control_means = tf.constant(rng.randn(horizon, num_rollouts, control_dim))
+    control_vars = tf.constant(0.1 * rng.rand(horizon, num_rollouts, control_dim))
+
+    state_means, state_vars = rollout_controls_in_dynamics_batched(
+        dynamics,
+        start_states,
+        control_means,
+        start_state_vars=start_state_vars,
+        control_vars=control_vars,
+    )
+    assert state_means.shape == (horizon + 1, num_rollouts, state_dim)
+    for b in range(num_rollouts):
+        expected_means, expected_vars = rollout_controls_in_dynamics(
+            dynamics,
+            start_states[b : b + 1],
+            control_means[:, b, :],
+            start_state_var=start_state_vars[b : b + 1],
+            control_vars=control_vars[:, b, :],
+        )
+        np.testing.assert_allclose(state_means[:, b, :], expected_means)
+        np.testing.assert_allclose(state_vars[:, b, :], expected_vars)
+
+
+def test_rollout_controls_in_dynamics_batched_unknown_batch_dim(dynamics, rng):
+    start_states = tf.constant(rng.randn(num_rollouts, state_dim))
+    control_means = tf.constant(rng.randn(horizon, num_rollouts, control_dim))
+
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec([None, state_dim], dtype=tf.float64),
+            tf.TensorSpec([horizon, None, control_dim], dtype=tf.float64),
+        ]
+    )
+    def rollout(start_states, control_means):
+        return rollout_controls_in_dynamics_batched(
+            dynamics, start_states, control_means
+        )
+
+    for compiled, expected in zip(
+        rollout(start_states, control_means),
+        rollout_controls_in_dynamics_batched(dynamics, start_states, control_means),
+    ):
+        np.testing.assert_allclose(compiled, expected)
+
+
+def test_prepare_cache_reused_until_invalidated(dynamics, rng):
+    cache = dynamics.prepare_cache()
+    assert dynamics.prepare_cache() is cache
+
+    gp = dynamics.mosvgpe.experts_list[dynamics.desired_mode].gp
+    gp.q_mu.assign(rng.randn(num_inducing, state_dim))
+    dynamics.invalidate_cache()
+    new_cache = dynamics.prepare_cache()
+    assert new_cache is not cache
+    np.testing.assert_allclose(
+        new_cache[0].q_mu, dynamics.desired_mode_dynamics_gp.prepare_cache()[0].q_mu
+    )
+
+    dynamics._num_updates.assign_add(1)  # as train_step does
+    assert dynamics.prepare_cache() is not new_cache